@@ -2,48 +2,499 @@
 
 import asyncio
 import aiohttp
-from bs4 import BeautifulSoup
+from html.parser import HTMLParser
+import json
+import mmap
+import os
 import sys
 
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
 
-async def get_download_links(filename: str) -> list:
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+SUFFIXES = (".tar.gz", ".sql.gz")
+MAX_DOWNLOADS = 3
+READ_BUFSIZE = 8 * 1024 * 1024
+CHUNK_SIZE = 256 * 1024
+WRITE_BATCH_SIZE = 1024 * 1024
+# writev fails with more buffers than IOV_MAX, which is 1024 on Linux and macOS
+WRITE_BATCH_CHUNKS = 512
+DIRECT_BUFFER_SIZE = 1024 * 1024
+DIRECT_ALIGNMENT = 4096
+SEGMENTS = 4
+SEGMENT_THRESHOLD = 64 * 1024 * 1024
+
+
+def is_backup_file(href: str) -> bool:
+    return href.split("?")[0].endswith(SUFFIXES)
+
+
+def get_download_links(filename: str) -> list:
     """Returns a list of files to download"""
+    if LexborHTMLParser is None:
+        return stream_download_links(filename)
     with open(filename, "r") as file:
         contents = file.read()
-    soup = BeautifulSoup(contents, features="lxml")
-    return [a["href"] for a in soup.find_all("a", href=True)]
+    tree = LexborHTMLParser(contents)
+    hrefs = (
+        node.attributes["href"]
+        for node in tree.css('a[href*=".tar.gz"], a[href*=".sql.gz"]')
+    )
+    return [href for href in hrefs if is_backup_file(href)]
+
+
+class LinkParser(HTMLParser):
+    """Collects the backup links, for when neither selectolax nor lxml is installed"""
+
+    def __init__(self):
+        super().__init__()
+        self.links = []
+
+    def handle_starttag(self, tag: str, attrs: list):
+        if tag != "a":
+            return
+        href = dict(attrs).get("href")
+        if href and is_backup_file(href):
+            self.links.append(href)
+
+
+def stream_download_links(filename: str) -> list:
+    """Same as get_download_links, without loading the whole file in memory"""
+    if etree is None:
+        parser = LinkParser()
+        with open(filename, "r") as file:
+            for block in iter(lambda: file.read(CHUNK_SIZE), ""):
+                parser.feed(block)
+        parser.close()
+        return parser.links
+    links = []
+    for _, element in etree.iterparse(filename, events=("end",), html=True):
+        if element.tag == "a":
+            href = element.get("href")
+            if href and is_backup_file(href):
+                links.append(href)
+        # Drop everything already seen, not only the links, or the tree still
+        # ends up fully built
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+    return links
+
+
+class Admission:
+    """Limits how many downloads run at once, the limit can be changed at runtime"""
 
+    def __init__(self, limit: int):
+        self.active = 0
+        self.limit = limit
+        self.cond = asyncio.Condition()
 
-async def clean_filename(filename: str) -> str:
+    async def acquire(self):
+        async with self.cond:
+            await self.cond.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+
+    async def release(self):
+        async with self.cond:
+            self.active -= 1
+            self.cond.notify(1)
+
+    async def set_limit(self, limit: int):
+        async with self.cond:
+            self.limit = limit
+            self.cond.notify_all()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.release()
+
+
+def clean_filename(filename: str) -> str:
     filename = filename.split("/")[-1]
     return filename.split("?")[0]
 
 
-async def download_file(session: aiohttp.ClientSession, url: str):
-    local_filename = await clean_filename(url)
-    print(f"Downloading {local_filename}")
-    async with session.get(url) as response:
-        with open(local_filename, "wb") as f:
-            while True:
-                chunk = await response.content.read(8192)
-                if not chunk:
-                    break
-                f.write(chunk)
-    print(f"Finished downloading {local_filename}")
+def write_chunks(fd: int, chunks: list, offset: int = None):
+    """Writes all chunks to fd, at offset if given, in a single syscall where possible"""
+    if offset is None:
+        written = os.writev(fd, chunks) if hasattr(os, "writev") else 0
+    else:
+        written = os.pwritev(fd, chunks, offset) if hasattr(os, "pwritev") else 0
+    if written == sum(len(chunk) for chunk in chunks):
+        return
+    view = memoryview(b"".join(chunks))[written:]
+    while view:
+        if offset is None:
+            count = os.write(fd, view)
+        else:
+            count = os.pwrite(fd, view, offset + written)
+            written += count
+        view = view[count:]
+
+
+class DirectWriter:
+    """Writes a file sequentially with O_DIRECT, bypassing the page cache"""
+
+    def __init__(self, filename: str):
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_DIRECT
+        self.fd = os.open(filename, flags, 0o644)
+        # Anonymous maps are page aligned, as O_DIRECT requires
+        self.buffer = mmap.mmap(-1, DIRECT_BUFFER_SIZE)
+        self.used = 0
+        self.size = 0
+
+    def write(self, chunks: list):
+        for chunk in chunks:
+            with memoryview(chunk) as view:
+                while view:
+                    count = min(len(view), DIRECT_BUFFER_SIZE - self.used)
+                    self.buffer[self.used : self.used + count] = view[:count]
+                    self.used += count
+                    self.size += count
+                    view = view[count:]
+                    if self.used == DIRECT_BUFFER_SIZE:
+                        self.flush(DIRECT_BUFFER_SIZE)
+
+    def flush(self, length: int):
+        with memoryview(self.buffer) as buffer:
+            view = buffer[:length]
+            while view:
+                view = view[os.write(self.fd, view) :]
+        self.used = 0
+
+    def close(self):
+        """Writes what is left, padded to the alignment, then cuts the padding"""
+        if self.used:
+            self.flush(-(-self.used // DIRECT_ALIGNMENT) * DIRECT_ALIGNMENT)
+            os.ftruncate(self.fd, self.size)
+        os.close(self.fd)
+        self.buffer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_direct(filename: str) -> DirectWriter:
+    """Returns a DirectWriter for filename, None where O_DIRECT is unsupported"""
+    if not hasattr(os, "O_DIRECT"):
+        return None
+    try:
+        return DirectWriter(filename)
+    except OSError:
+        return None
+
+
+async def iter_batches(response: aiohttp.ClientResponse):
+    """Yields the response body as lists of chunks of about WRITE_BATCH_SIZE,
+    and never more than WRITE_BATCH_CHUNKS of them"""
+    batch = []
+    pending = 0
+    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+        batch.append(chunk)
+        pending += len(chunk)
+        if pending >= WRITE_BATCH_SIZE or len(batch) >= WRITE_BATCH_CHUNKS:
+            yield batch, pending
+            batch = []
+            pending = 0
+    if batch:
+        yield batch, pending
+
+
+async def get_file_info(session: aiohttp.ClientSession, url: str) -> tuple:
+    """Returns the size announced by the server, 0 when unknown, whether it
+    accepts range requests and the validator to resume with, if any"""
+    # Asking for the first byte gives the size in Content-Range and proves
+    # ranges work, with the same request signature the download will use
+    headers = {"Range": "bytes=0-0"}
+    async with session.get(url, headers=headers) as response:
+        if response.status in (206, 416):
+            total = response.headers.get("Content-Range", "").rpartition("/")[2]
+            size = int(total) if total.isdigit() else 0
+            if response.status == 206:
+                # Read the single byte so the connection can be reused
+                await response.read()
+        else:
+            # Ranges aren't supported, leave the body alone
+            size = int(response.headers.get("Content-Length", 0))
+        accepts_ranges = response.status == 206
+        etag = response.headers.get("ETag")
+        if etag and etag.startswith("W/"):
+            # If-Range only accepts strong validators
+            etag = None
+        return size, accepts_ranges, etag or response.headers.get("Last-Modified")
+
+
+async def write_in_thread(func, *args):
+    """Runs a write in a thread. If cancelled, still waits for the write to
+    finish, so the file is never closed while the thread is using it"""
+    write = asyncio.ensure_future(asyncio.to_thread(func, *args))
+    cancelled = False
+    # Keep waiting however many times we get cancelled, the thread can't be
+    # stopped and must be done with the file before anyone closes it
+    while not write.done():
+        try:
+            await asyncio.shield(write)
+        except asyncio.CancelledError:
+            cancelled = True
+    if cancelled:
+        raise asyncio.CancelledError
+    return write.result()
+
+
+async def download_segment(
+    session: aiohttp.ClientSession,
+    url: str,
+    fd: int,
+    segment: list,
+    validator: str,
+):
+    """Downloads the [offset, end) range of the file, moving offset forward as
+    the data is written so an interrupted segment can be resumed"""
+    if segment[0] >= segment[1]:
+        return
+    headers = {"Range": f"bytes={segment[0]}-{segment[1] - 1}"}
+    if validator:
+        headers["If-Range"] = validator
+    async with session.get(url, headers=headers) as response:
+        response.raise_for_status()
+        if response.status != 206:
+            raise RuntimeError(
+                f"Server ignored the range request for {url}, "
+                "or the file changed since the download started"
+            )
+        async for batch, size in iter_batches(response):
+            await write_in_thread(write_chunks, fd, batch, segment[0])
+            segment[0] += size
+
+
+def load_segments(state_filename: str, size: int, validator: str) -> list:
+    """Returns the segments left from an interrupted download of the same file,
+    None if there is nothing usable to resume"""
+    if not validator:
+        return None
+    try:
+        with open(state_filename, "r") as file:
+            state = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if state.get("size") != size or state.get("validator") != validator:
+        return None
+    return state["segments"]
+
+
+def save_segments(state_filename: str, segments: list, size: int, validator: str):
+    with open(state_filename, "w") as file:
+        json.dump({"size": size, "validator": validator, "segments": segments}, file)
+
+
+async def download_segmented(
+    session: aiohttp.ClientSession, url: str, local_filename: str, info: tuple
+):
+    """Downloads the file over SEGMENTS parallel range requests, resuming the
+    segments of a previous interrupted run"""
+    size, _, validator = info
+    # Preallocated files have their final size from the start, keep them
+    # under another name until complete so they are never taken for finished
+    partial_filename = f"{local_filename}.part"
+    state_filename = f"{partial_filename}.json"
+    segments = None
+    if os.path.exists(partial_filename):
+        segments = load_segments(state_filename, size, validator)
+    if segments is None:
+        fd = os.open(partial_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        step = -(-size // SEGMENTS)
+        segments = [[start, min(start + step, size)] for start in range(0, size, step)]
+    else:
+        fd = os.open(partial_filename, os.O_WRONLY)
+    try:
+        if hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(fd, 0, size)
+        tasks = [
+            asyncio.create_task(
+                download_segment(session, url, fd, segment, validator)
+            )
+            for segment in segments
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # Stop the other segments before fd is closed under them
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # Only record progress once the data it describes is on disk
+            os.fsync(fd)
+            save_segments(state_filename, segments, size, validator)
+            raise
+    finally:
+        os.close(fd)
+    os.replace(partial_filename, local_filename)
+    if os.path.exists(state_filename):
+        os.remove(state_filename)
+
+
+async def download_single(
+    session: aiohttp.ClientSession,
+    url: str,
+    local_filename: str,
+    info: tuple,
+    direct: bool,
+):
+    """Downloads the file in one request, resuming a previous partial download"""
+    size, accepts_ranges, validator = info
+    resumable = accepts_ranges and validator and size > 0
+    # Like download_segmented, only give the file its real name once complete
+    partial_filename = f"{local_filename}.part"
+    state_filename = f"{partial_filename}.json"
+    segment = [0, size]
+    if resumable and os.path.exists(partial_filename):
+        # The saved state says which version of the file the partial download
+        # belongs to and how much of it was safely written
+        segments = load_segments(state_filename, size, validator)
+        if (
+            segments
+            and len(segments) == 1
+            and segments[0][1] == size
+            and segments[0][0] <= os.path.getsize(partial_filename)
+        ):
+            segment = segments[0]
+    if segment[0] and segment[0] >= size:
+        os.replace(partial_filename, local_filename)
+        os.remove(state_filename)
+        return
+    headers = {}
+    if segment[0]:
+        headers = {"Range": f"bytes={segment[0]}-", "If-Range": validator}
+    async with session.get(url, headers=headers) as response:
+        response.raise_for_status()
+        if response.status != 206:
+            # The file changed upstream, the server sent all of it
+            segment[0] = 0
+        if not segment[0] and os.path.exists(state_filename):
+            os.remove(state_filename)
+        writer = None
+        if direct and not segment[0]:
+            writer = open_direct(partial_filename)
+        if writer is not None:
+            with writer:
+                async for batch, _ in iter_batches(response):
+                    await write_in_thread(writer.write, batch)
+        else:
+            flags = os.O_WRONLY | os.O_CREAT
+            if not segment[0]:
+                flags |= os.O_TRUNC
+            fd = os.open(partial_filename, flags, 0o644)
+            try:
+                # A preallocated file can't be resumed, its size says nothing
+                # about how much was written, so only do it when there is no
+                # way to resume it anyway
+                if not resumable and size > 0 and hasattr(os, "posix_fallocate"):
+                    os.posix_fallocate(fd, 0, size)
+                os.lseek(fd, segment[0], os.SEEK_SET)
+                try:
+                    async for batch, batch_size in iter_batches(response):
+                        await write_in_thread(write_chunks, fd, batch)
+                        segment[0] += batch_size
+                except BaseException:
+                    if resumable:
+                        # Only record progress once the data it describes is on disk
+                        os.fsync(fd)
+                        save_segments(state_filename, [segment], size, validator)
+                    raise
+            finally:
+                os.close(fd)
+    os.replace(partial_filename, local_filename)
+    if os.path.exists(state_filename):
+        os.remove(state_filename)
+
+
+async def download_file(
+    session: aiohttp.ClientSession,
+    url: str,
+    info: tuple,
+    admission: Admission,
+    direct: bool = False,
+):
+    local_filename = clean_filename(url)
+    size, accepts_ranges, _ = info
+    # Files only get their real name once complete
+    if size and os.path.exists(local_filename):
+        if os.path.getsize(local_filename) == size:
+            print(f"Already downloaded {local_filename}")
+            return local_filename
+    # Direct writes have to be sequential, so they aren't segmented
+    segmented = (
+        not direct
+        and accepts_ranges
+        and size > SEGMENT_THRESHOLD
+        and hasattr(os, "pwrite")
+    )
+    async with admission:
+        print(f"Downloading {local_filename}")
+        if segmented:
+            await download_segmented(session, url, local_filename, info)
+        else:
+            await download_single(session, url, local_filename, info, direct)
+        print(f"Finished downloading {local_filename}")
     return local_filename
 
 
 async def main(args: list):
+    direct = "--direct" in args[1:]
+    if direct:
+        args = [arg for arg in args if arg != "--direct"]
     if len(args) != 2:
-        print(f"Usage {args[0]} filename")
+        print(f"Usage {args[0]} [--direct] filename")
         raise SystemExit(1)
 
-    async with aiohttp.ClientSession() as session:
-        download_links = await get_download_links(args[1])
+    # Parse the index in a thread while the session is being set up
+    parse_task = asyncio.create_task(asyncio.to_thread(get_download_links, args[1]))
+
+    connector = aiohttp.TCPConnector(
+        limit=MAX_DOWNLOADS * SEGMENTS,
+        limit_per_host=MAX_DOWNLOADS * SEGMENTS,
+        ttl_dns_cache=300,
+        keepalive_timeout=75,
+        force_close=False,
+        enable_cleanup_closed=True,
+    )
+    timeout = aiohttp.ClientTimeout(total=None, sock_read=300)
+    # The backups are already gzipped, they must be saved byte for byte
+    headers = {"Connection": "keep-alive", "Accept-Encoding": "identity"}
+    async with aiohttp.ClientSession(
+        connector=connector,
+        timeout=timeout,
+        headers=headers,
+        read_bufsize=READ_BUFSIZE,
+        auto_decompress=False,
+    ) as session:
+        download_links = await parse_task
+        admission = Admission(MAX_DOWNLOADS)
+
+        # Start with the biggest files so a large one doesn't finish last alone
+        infos = await asyncio.gather(
+            *(get_file_info(session, file) for file in download_links)
+        )
+        downloads = sorted(
+            zip(download_links, infos), key=lambda item: item[1][0], reverse=True
+        )
 
         # Launch a download task for each file
         tasks = [
-            asyncio.create_task(download_file(session, file)) for file in download_links
+            asyncio.create_task(download_file(session, file, info, admission, direct))
+            for file, info in downloads
         ]
 
         # Wait for all tasks to complete